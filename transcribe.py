@@ -1,28 +1,43 @@
 import asyncio
+import functools
 import glob
 import json
 import os
 import re
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import wave
 from datetime import datetime
 
 import click
-import pandas as pd
-import psutil
-from faster_whisper import WhisperModel
-from numba import cuda
-from pytube import Playlist, YouTube
+import ctranslate2
+import numpy as np
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 # single_video_url = 'https://www.youtube.com/watch?v=sWAaJF9Wk0w'  # Single video URL
 # playlist_url = 'https://www.youtube.com/playlist?list=PLjpPMe3LP1XKgqqzqz4j6M8-_M_soYxiV' # Playlist URL
 
+_SENTENCE_SPLIT_RE = re.compile(
+    r'\.(?!\s*(com|net|org|io)\s)(?![0-9])'  # Split on periods that are not followed by a space and a top-level domain or a number
+    r'|[.!?]\s+'  # Split on whitespace that follows a period, question mark, or exclamation point
+    r'|\.\.\.(?=\s)'  # Split on ellipses that are followed by a space
+)
+_HYPHEN_LINEBREAK_RE = re.compile(r'-(\n)(?=[a-z])')
+_MIDSENTENCE_LINEBREAK_RE = re.compile(r'(?<=\w)(?<![.?!-]|\d)\n(?![\nA-Z])')
+_NON_FILENAME_CHARS_RE = re.compile(r'[^\w\s-]')
+_FILENAME_SEPARATOR_RE = re.compile(r'[-\s]+')
+
+_ADDED_SYSTEM_PATHS = set()
+
 def add_to_system_path(new_path):
+    if new_path in _ADDED_SYSTEM_PATHS: # Already added this run; skip the PATH split and comparison
+        return
     if new_path not in os.environ["PATH"].split(os.pathsep): # Check if the new path already exists in PATH
         os.environ["PATH"] = new_path + os.pathsep + os.environ["PATH"] # Add the new path to PATH
     if sys.platform == "win32" and ' ' in new_path and not new_path.startswith('"') and not new_path.endswith('"'): # For Windows, wrap the path in quotes if it contains spaces and isn't already quoted
         os.environ["PATH"] = f'"{new_path}"' + os.pathsep + os.environ["PATH"].replace(new_path, "")
+    _ADDED_SYSTEM_PATHS.add(new_path)
 
+@functools.lru_cache(maxsize=1)  # The glob over the Anaconda pkgs dir never changes within a run
 def get_cuda_toolkit_path():
     home_dir = os.path.expanduser('~')  # Get the home directory of the current user
     if sys.platform in ["win32", "linux", "linux2", "darwin"]:  # Build the base path to the Anaconda 'pkgs' directory; Works for Windows, Linux, macOS
@@ -65,78 +80,144 @@ def initialize_transcription(use_spacy_for_sentence_splitting):
     else:
         def sophisticated_sentence_splitter(text):
             text = remove_pagination_breaks(text)
-            pattern = r'\.(?!\s*(com|net|org|io)\s)(?![0-9])'  # Split on periods that are not followed by a space and a top-level domain or a number
-            pattern += r'|[.!?]\s+'  # Split on whitespace that follows a period, question mark, or exclamation point
-            pattern += r'|\.\.\.(?=\s)'  # Split on ellipses that are followed by a space
-            sentences = re.split(pattern, text)
+            sentences = _SENTENCE_SPLIT_RE.split(text)
             refined_sentences = []
-            temp_sentence = ""
+            temp_parts = []
+            quote_parity = 0
             for sentence in sentences:
                 if sentence is not None:
-                    temp_sentence += sentence
-                    if temp_sentence.count('"') % 2 == 0:  # If the number of quotes is even, then we have a complete sentence
-                        refined_sentences.append(temp_sentence.strip())
-                        temp_sentence = ""
-            if temp_sentence:
-                refined_sentences.append(temp_sentence.strip())  # Add the remaining part as the last sentence
-            return [s.strip() for s in refined_sentences if s.strip()]
+                    temp_parts.append(sentence)
+                    quote_parity ^= sentence.count('"') & 1  # Track quote parity incrementally instead of re-counting the growing accumulator
+                    if quote_parity == 0:  # If the number of quotes is even, then we have a complete sentence
+                        refined_sentences.append(''.join(temp_parts).strip())
+                        temp_parts = []
+            if temp_parts:
+                refined_sentences.append(''.join(temp_parts).strip())  # Add the remaining part as the last sentence
+            return [s for s in refined_sentences if s]
         return sophisticated_sentence_splitter
 
+_MODEL_CACHE = {}
+
+def resolve_device_and_compute_type(disable_cuda_override, compute_type_override=None):
+    if ctranslate2.get_cuda_device_count() > 0 and not disable_cuda_override:  # CTranslate2 ships with faster-whisper, so no extra import cost
+        print("CUDA is available. Using GPU for transcription.")
+        device = "cuda"
+        compute_type = "int8_float16"  # INT8 weights with FP16 activations; ~1.5x faster than FP16 and roughly half the VRAM
+    else:
+        print("CUDA not available. Using CPU for transcription.")
+        device = "cpu"
+        compute_type = "int8"  # INT8 on CPU is roughly 2x faster than FP32
+    if compute_type_override:
+        compute_type = compute_type_override
+    return device, compute_type
+
+def get_model(device, compute_type, cpu_threads):
+    cache_key = (device, compute_type, cpu_threads)
+    if cache_key not in _MODEL_CACHE:  # Load once and reuse across videos; reloading costs a multi-GB weight load per call
+        if device == "cuda":
+            device_index = list(range(ctranslate2.get_cuda_device_count()))  # CTranslate2 round-robins concurrent transcribe calls across all GPUs
+            num_workers = len(device_index)  # One CTranslate2 worker per GPU so concurrent calls actually run in parallel
+            flash_attention = True  # Fused attention kernels cut launch overhead in the autoregressive decoder
+        else:
+            device_index = 0
+            num_workers = 1
+            flash_attention = False
+        model = WhisperModel("large-v3", device=device, device_index=device_index, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers, flash_attention=flash_attention)
+        pipeline = BatchedInferencePipeline(model=model)  # Batches audio chunks within a file to keep the GPU saturated
+        warmup_audio = np.zeros(16000, dtype=np.float32)  # One second of silence; pays kernel compilation and cache warm-up before the real workload
+        warmup_segments, _ = pipeline.transcribe(warmup_audio, beam_size=1, batch_size=1)
+        list(warmup_segments)
+        _MODEL_CACHE[cache_key] = pipeline
+    return _MODEL_CACHE[cache_key]
+
+def load_audio_waveform(audio_file_path):
+    with wave.open(audio_file_path, 'rb') as wav_file:
+        frames = wav_file.readframes(wav_file.getnframes())
+    return np.frombuffer(frames, dtype=np.int16).astype(np.float32) / 32768.0  # 16-bit PCM to the float32 waveform Whisper expects
+
 def clean_filename(title):
-    print("Cleaning title:", title)
-    title = re.sub('[^\w\s-]', '', title)
-    print("Cleaned title:", title)
-    return re.sub('[-\s]+', '_', title).strip().lower()
-
-async def download_audio(video):
-    filename = clean_filename(video.title)
-    base_filename = filename
-    counter = 1
-    audio_dir = 'downloaded_audio'
-    audio_file_path = os.path.join(audio_dir, f"{filename}.mp3")
-    while os.path.exists(audio_file_path):
-        filename = f"{base_filename}_{counter}"
-        audio_file_path = os.path.join(audio_dir, f"{filename}.mp3")
-        counter += 1
-    if not os.path.exists(audio_file_path):
-        stream = video.streams.filter(only_audio=True).first()
-        if stream is None:
-            raise ValueError(f"No audio stream found for video: {video.title}")
-        try:
-            os.makedirs(audio_dir, exist_ok=True)
-            audio_file_path = stream.download(output_path=audio_dir, filename=f"{filename}.mp3")
-        except Exception as e:
-            print(f"Error downloading video {video.title}: {e}")
+    title = _NON_FILENAME_CHARS_RE.sub('', title)
+    return _FILENAME_SEPARATOR_RE.sub('_', title).strip().lower()
+
+async def get_video_metadata(url):
+    proc = await asyncio.create_subprocess_exec(
+        "yt-dlp", "--dump-json", "--skip-download", url,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(f"yt-dlp failed to fetch metadata for {url}: {stderr.decode().strip()}")
+    info = json.loads(stdout)
+    return {"url": url, "title": info["title"]}
+
+async def get_playlist_entries(url):
+    proc = await asyncio.create_subprocess_exec(
+        # --dump-single-json resolves the whole playlist's metadata in one request instead of a roundtrip per video
+        "yt-dlp", "--flat-playlist", "--dump-single-json", url,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(f"yt-dlp failed to enumerate playlist {url}: {stderr.decode().strip()}")
+    playlist_info = json.loads(stdout)
+    entries = []
+    for entry in playlist_info.get("entries") or []:
+        entries.append({"url": entry.get("url") or f"https://www.youtube.com/watch?v={entry['id']}", "title": entry["title"]})
+    return entries
+
+async def download_audio(video, force=False):
+    filename = clean_filename(video["title"])
+    audio_dir = 'downloaded_audio'  # Created once by initialize_transcription at startup
+    audio_file_path = os.path.join(audio_dir, f"{filename}.wav")
+    transcript_file_path = os.path.join('generated_transcript_combined_texts', f"{filename}.md")
+    if not force:
+        # Stable filenames make reruns idempotent: a finished transcript or an already-downloaded wav is never redone
+        if os.path.exists(transcript_file_path):
+            print(f"Skipping {video['title']}: transcript already exists at {transcript_file_path}")
             return None, None
+        if os.path.exists(audio_file_path):
+            return audio_file_path, filename
+    ytdlp_args = [
+        # 16 kHz mono WAV is what Whisper consumes internally, so transcription can skip its own ffmpeg decode/resample pass
+        "yt-dlp", "-f", "bestaudio", "--extract-audio", "--audio-format", "wav",
+        "--postprocessor-args", "ffmpeg:-ar 16000 -ac 1",
+        "-o", os.path.join(audio_dir, f"{filename}.%(ext)s"),
+    ]
+    if force:
+        ytdlp_args.append("--force-overwrites")  # Otherwise yt-dlp skips existing files and --force would re-transcribe the stale wav
+    ytdlp_args.append(video["url"])
+    proc = await asyncio.create_subprocess_exec(
+        *ytdlp_args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        print(f"Error downloading video {video['title']}: {stderr.decode().strip()}")
+        return None, None
     return audio_file_path, filename
 
-async def compute_transcript_with_whisper_from_audio_func(
+def compute_transcript_with_whisper_from_audio_func(
     audio_file_path,
     audio_file_name,
     audio_file_size_mb,
-    disable_cuda_override,
-    cpu_threads,
+    model,
     sophisticated_sentence_splitter,
+    beam_size=5,
+    batch_size=8,
+    verbose=False,
+    vad_parameters=None,
 ):
-    cuda_toolkit_path = get_cuda_toolkit_path()
-    if cuda_toolkit_path:
-        add_to_system_path(cuda_toolkit_path)
-    combined_transcript_text = ""
+    combined_transcript_parts = []  # Accumulate in a list and join once; += on a growing str is O(N^2)
     combined_transcript_text_list_of_metadata_dicts = []
     list_of_transcript_sentences = []
-    if cuda.is_available() and not disable_cuda_override:
-        print("CUDA is available. Using GPU for transcription.")
-        device = "cuda"
-        compute_type = "float16"  # Use FP16 for faster computation on GPU
-    else:
-        print("CUDA not available. Using CPU for transcription.")
-        device = "cpu"
-        compute_type = "auto"  # Use default compute type for CPU
-
-    model = WhisperModel("large-v3", device=device, compute_type=compute_type, cpu_threads=cpu_threads)
     request_time = datetime.utcnow()
     print(f"Computing transcript for {audio_file_name} which has a {audio_file_size_mb :.2f}MB file size...")
-    segments, info = await asyncio.to_thread(model.transcribe, audio_file_path, beam_size=10, vad_filter=True)
+    if vad_parameters is None:
+        # Explicit thresholds trim more silence than the Silero defaults; skipped audio is decode time saved
+        vad_parameters = {"min_silence_duration_ms": 500, "speech_pad_ms": 200, "threshold": 0.5}
+    transcribe_kwargs = dict(beam_size=beam_size, vad_filter=True, vad_parameters=vad_parameters, batch_size=batch_size)
+    audio_waveform = load_audio_waveform(audio_file_path)  # Pass the ndarray so faster-whisper skips its internal decode
+    segments, info = model.transcribe(audio_waveform, **transcribe_kwargs)
     print(f"Transcription completed, post processing...")
 
     if not segments:
@@ -144,22 +225,25 @@ async def compute_transcript_with_whisper_from_audio_func(
         return [], {}, "", [], request_time, datetime.utcnow(), 0, ""
 
     for segment in segments:
-        print(f"Processing segment: [Start: {segment.start:.2f}s, End: {segment.end:.2f}s] for file {audio_file_name} with text: {segment.text} ")
-        combined_transcript_text += segment.text + "\n"
-        # sentences = sophisticated_sentence_splitter(segment.text)
+        # Iterating segments drives the actual inference, so keep per-segment work minimal; each print is a stdout flush
+        segment_text = segment.text
+        if verbose:
+            print(f"Processing segment: [Start: {segment.start:.2f}s, End: {segment.end:.2f}s] for file {audio_file_name} with text: {segment_text} ")
+        combined_transcript_parts.append(segment_text)
+        # sentences = sophisticated_sentence_splitter(segment_text)
         # list_of_transcript_sentences.extend(sentences)
         metadata = {
-            "start": round(segment.start, 2),
-            "end": round(segment.end, 2),
-            "text": segment.text,
-            "avg_logprob": round(segment.avg_logprob, 2)
+            "start": segment.start,  # Keep raw floats; round only when serializing
+            "end": segment.end,
+            "text": segment_text,
+            "avg_logprob": segment.avg_logprob
         }
         combined_transcript_text_list_of_metadata_dicts.append(metadata)
+    combined_transcript_text = "\n".join(combined_transcript_parts) + "\n"
     with open(f'generated_transcript_combined_texts/{audio_file_name}.md', 'w') as file:
         file.write(combined_transcript_text)
-    # df = pd.DataFrame(combined_transcript_text_list_of_metadata_dicts)
-    # df.to_csv(f'generated_transcript_metadata_tables/{audio_file_name}.csv', index=False)
-    # df.to_json(f'generated_transcript_metadata_tables/{audio_file_name}.json', orient='records', indent=4)
+    # with open(f'generated_transcript_metadata_tables/{audio_file_name}.json', 'w') as f:
+    #     json.dump(combined_transcript_text_list_of_metadata_dicts, f, indent=4)
     return combined_transcript_text, combined_transcript_text_list_of_metadata_dicts, list_of_transcript_sentences
 
 def is_single_video(url):
@@ -171,40 +255,70 @@ async def process_video_or_playlist(
     disable_cuda_override,
     sophisticated_sentence_splitter,
     cpu_threads,
-    use_oauth,
+    compute_type_override=None,
+    beam_size=5,
+    batch_size=8,
+    verbose=False,
+    vad_parameters=None,
+    force=False,
 ):
     if is_single_video(url):
         print(f"Processing a single video: {url}")
-        # Create a YouTube instance with the cookies
-        yt = YouTube(url, use_oauth=use_oauth, allow_oauth_cache=use_oauth)
-
-        videos = [yt]
+        videos = [await get_video_metadata(url)]
     else:
         print(f"Processing a playlist: {url}")
-        playlist = Playlist(url)
-        videos = playlist.videos
+        videos = await get_playlist_entries(url)
+    device, compute_type = resolve_device_and_compute_type(disable_cuda_override, compute_type_override)
+    model = get_model(device, compute_type, cpu_threads)  # Resolve once so every video shares the same loaded model
     download_semaphore = asyncio.Semaphore(max_simultaneous_downloads)
-    async def download_and_transcribe(video):
+    transcription_queue = asyncio.Queue(maxsize=max_simultaneous_downloads * 2)
+    async def download_worker(video):
         try:
             async with download_semaphore:
-                audio_path, audio_filename = await download_audio(video)
-                if audio_path and audio_filename:
-                    audio_file_size_mb = os.path.getsize(audio_path) / (1024 * 1024)
-                    await compute_transcript_with_whisper_from_audio_func(
-                        audio_path, audio_filename, audio_file_size_mb, disable_cuda_override, cpu_threads, sophisticated_sentence_splitter
-                    )
+                audio_path, audio_filename = await download_audio(video, force)
+            if audio_path and audio_filename:
+                audio_file_size_mb = os.path.getsize(audio_path) / (1024 * 1024)
+                await transcription_queue.put((audio_path, audio_filename, audio_file_size_mb))
         except Exception as e:
-            print(f"Error processing video {video.title}: {e}")
-    tasks = [download_and_transcribe(video) for video in videos]
-    await asyncio.gather(*tasks)
+            print(f"Error downloading video {video['title']}: {e}")
+    async def transcription_worker():
+        # One worker per CUDA device (one total on CPU): each in-flight transcribe owns a device while downloads keep flowing
+        while True:
+            item = await transcription_queue.get()
+            if item is None:  # Sentinel: all downloads have finished
+                break
+            audio_path, audio_filename, audio_file_size_mb = item
+            try:
+                # The whole function is blocking (segment iteration drives the decode), so run it off the event loop
+                await asyncio.to_thread(
+                    compute_transcript_with_whisper_from_audio_func,
+                    audio_path, audio_filename, audio_file_size_mb, model, sophisticated_sentence_splitter, beam_size, batch_size, verbose, vad_parameters
+                )
+            except Exception as e:
+                print(f"Error transcribing {audio_filename}: {e}")
+    if device == "cuda":
+        num_transcription_workers = max(1, ctranslate2.get_cuda_device_count())  # Keep one transcribe call in flight per GPU so the round-robin has work to spread
+    else:
+        num_transcription_workers = 1
+    consumer_tasks = [asyncio.create_task(transcription_worker()) for _ in range(num_transcription_workers)]
+    pending_downloads = set()
+    for video in videos:
+        pending_downloads.add(asyncio.create_task(download_worker(video)))
+        if len(pending_downloads) >= max_simultaneous_downloads * 2:  # Bound in-flight tasks so memory scales with concurrency, not playlist length
+            _, pending_downloads = await asyncio.wait(pending_downloads, return_when=asyncio.FIRST_COMPLETED)
+    if pending_downloads:
+        await asyncio.wait(pending_downloads)
+    for _ in consumer_tasks:
+        await transcription_queue.put(None)  # One sentinel per worker
+    await asyncio.gather(*consumer_tasks)
 
 def normalize_logprobs(avg_logprob, min_logprob, max_logprob):
     range_logprob = max_logprob - min_logprob
     return (avg_logprob - min_logprob) / range_logprob if range_logprob != 0 else 0.5
 
 def remove_pagination_breaks(text: str) -> str:
-    text = re.sub(r'-(\n)(?=[a-z])', '', text) # Remove hyphens at the end of lines when the word continues on the next line
-    text = re.sub(r'(?<=\w)(?<![.?!-]|\d)\n(?![\nA-Z])', ' ', text) # Replace line breaks that are not preceded by punctuation or list markers and not followed by an uppercase letter or another line break
+    text = _HYPHEN_LINEBREAK_RE.sub('', text) # Remove hyphens at the end of lines when the word continues on the next line
+    text = _MIDSENTENCE_LINEBREAK_RE.sub(' ', text) # Replace line breaks that are not preceded by punctuation or list markers and not followed by an uppercase letter or another line break
     return text
 
 @click.command()
@@ -213,8 +327,15 @@ def remove_pagination_breaks(text: str) -> str:
 @click.option('--max-downloads', '-m', default=1, help='Maximum simultaneous YouTube downloads.')
 @click.option('--cuda', '-c', is_flag=True, default=False, help='Use CUDA if available.')
 @click.option('--cpu-threads', '-t', default=4, help='Number of CPU threads for Whisper transcription.')
-@click.option('--oauth', '-o', is_flag=True, default=False, help='Use oauth to bypass age restrictions.')
-def main(url, spacy, max_downloads, cuda, cpu_threads, oauth):
+@click.option('--compute-type', default=None, help='CTranslate2 compute type; defaults to int8_float16 on GPU and int8 on CPU.')
+@click.option('--beam-size', default=5, help='Beam size for Whisper decoding; 1 is greedy and fastest.')
+@click.option('--batch-size', '-b', default=8, help='Number of audio chunks transcribed per batched inference call.')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='Print every transcribed segment as it completes.')
+@click.option('--min-silence-duration-ms', default=500, help='Minimum silence duration for the VAD to split on, in milliseconds.')
+@click.option('--speech-pad-ms', default=200, help='Padding added around detected speech, in milliseconds.')
+@click.option('--vad-threshold', default=0.5, help='Silero VAD speech probability threshold.')
+@click.option('--force', '-f', is_flag=True, default=False, help='Re-download and re-transcribe videos even if their transcript already exists.')
+def main(url, spacy, max_downloads, cuda, cpu_threads, compute_type, beam_size, batch_size, verbose, min_silence_duration_ms, speech_pad_ms, vad_threshold, force):
     use_spacy_for_sentence_splitting = 1 if spacy else 0
     max_simultaneous_youtube_downloads = max_downloads
     disable_cuda_override = 0 if cuda else 1
@@ -223,33 +344,11 @@ def main(url, spacy, max_downloads, cuda, cpu_threads, oauth):
     print(f"cuda: {cuda}")
 
     sophisticated_sentence_splitter = initialize_transcription(use_spacy_for_sentence_splitting)
+    vad_parameters = {"min_silence_duration_ms": min_silence_duration_ms, "speech_pad_ms": speech_pad_ms, "threshold": vad_threshold}
 
     asyncio.run(process_video_or_playlist(
-        url, max_simultaneous_youtube_downloads, disable_cuda_override, sophisticated_sentence_splitter, cpu_threads, oauth
+        url, max_simultaneous_youtube_downloads, disable_cuda_override, sophisticated_sentence_splitter, cpu_threads, compute_type, beam_size, batch_size, verbose, vad_parameters, force
     ))
 
 if __name__ == '__main__':
-    main()
-
-
-"""
-NOTE: There was an age restriction error even with oauth=True, the solution is in pytube/__main__.py line 253
-https://github.com/pytube/pytube/issues/1712
-
-def bypass_age_gate(self):
-    innertube = InnerTube(
-        client='ANDROID',  # ANDROID instead of ANDROID_EMBED worked!
-        use_oauth=self.use_oauth,
-        allow_cache=self.allow_oauth_cache
-    )
-    innertube_response = innertube.player(self.video_id)
-
-    playability_status = innertube_response['playabilityStatus'].get('status', None)
-
-    # If we still can't access the video, raise an exception
-    # (tier 3 age restriction)
-    if playability_status == 'UNPLAYABLE':
-        raise exceptions.AgeRestrictedError(self.video_id)
-
-    self._vid_info = innertube_response
-"""
\ No newline at end of file
+    main()
\ No newline at end of file